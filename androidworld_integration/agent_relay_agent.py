@@ -1,54 +1,238 @@
 """AndroidWorld agent adapter for Agent Relay.
 
 Implements the EnvironmentInteractingAgent interface by sending ADB broadcasts
-to Agent Relay's BenchmarkReceiver and polling for results.
+to Agent Relay's BenchmarkReceiver and waiting on the device for results.
 """
 
+import itertools
 import json
-import subprocess
+import os
+import re
+import shlex
+import socket
+import struct
 import time
 import uuid
 from typing import Any
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # ijson is optional; fall back to reading the full result
+    ijson = None
+
+# Shared by all agents so task ids stay unique across devices in one process
+_task_counter = itertools.count()
+
+
+class _AdbClient:
+    """Minimal client for the adb server's smart-socket protocol.
+
+    Talks to the already-running adb server directly instead of spawning
+    the adb binary for every command. Each service (shell, exec) gets its
+    own socket, as the server hands the connection over to the device.
+    """
+
+    # shell v2 packet ids
+    STDIN, STDOUT, STDERR, EXIT, CLOSE_STDIN = 0, 1, 2, 3, 4
+
+    def __init__(self, serial: str | None = None, host: str = "127.0.0.1", port: int | None = None):
+        # Like the adb binary, fall back to ANDROID_SERIAL when no serial is given
+        self.serial = serial or os.environ.get("ANDROID_SERIAL")
+        self.host = host
+        self.port = port or int(os.environ.get("ANDROID_ADB_SERVER_PORT", "5037"))
+
+    def connect(self, timeout: float | None = None) -> socket.socket:
+        return socket.create_connection((self.host, self.port), timeout=timeout)
+
+    @staticmethod
+    def _send(sock: socket.socket, cmd: str) -> None:
+        data = cmd.encode()
+        sock.sendall(f"{len(data):04x}".encode() + data)
+
+    @staticmethod
+    def _recv_exact(sock: socket.socket, size: int) -> bytes:
+        buf = b""
+        while len(buf) < size:
+            chunk = sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("adb connection closed unexpectedly")
+            buf += chunk
+        return buf
+
+    def _recv_status(self, sock: socket.socket) -> None:
+        status = self._recv_exact(sock, 4)
+        if status == b"OKAY":
+            return
+        length = int(self._recv_exact(sock, 4), 16)
+        message = self._recv_exact(sock, length).decode(errors="replace")
+        raise RuntimeError(f"adb server error: {message}")
+
+    def open(self, service: str, timeout: float | None = None) -> socket.socket:
+        """Open a device service (e.g. ``shell,v2,raw:``) on its own socket.
+
+        `timeout` bounds every blocking operation on the returned socket.
+        """
+        sock = self.connect(timeout)
+        try:
+            self._send(sock, f"host:transport:{self.serial}" if self.serial else "host:transport-any")
+            self._recv_status(sock)
+            self._send(sock, service)
+            self._recv_status(sock)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def send_packet(self, sock: socket.socket, packet_id: int, data: bytes = b"") -> None:
+        sock.sendall(struct.pack("<BI", packet_id, len(data)) + data)
+
+    def recv_packet(self, sock: socket.socket) -> tuple[int, bytes]:
+        packet_id, length = struct.unpack("<BI", self._recv_exact(sock, 5))
+        return packet_id, self._recv_exact(sock, length)
+
+    def exec_out(self, cmdline: str, timeout: float | None = None) -> bytes:
+        """Run a command and return its raw, untranslated output."""
+        sock = self.open(f"exec:{cmdline}", timeout)
+        chunks = []
+        try:
+            while chunk := sock.recv(65536):
+                chunks.append(chunk)
+        finally:
+            sock.close()
+        return b"".join(chunks)
+
 
 class AgentRelayAgent:
     """Agent that delegates to Agent Relay running on an Android device."""
 
     PACKAGE = "com.agentrelay"
     RECEIVER = f"{PACKAGE}/.benchmark.BenchmarkReceiver"
+    # Broadcast commands are built as a single shell string to avoid adb
+    # shell argument splitting issues with spaces/quotes. The static part is
+    # formatted once here; only the action and quoted extras vary per call.
+    BROADCAST_TEMPLATE = (
+        f"am broadcast -n {PACKAGE}/{PACKAGE}.benchmark.BenchmarkReceiver -a {{action}}"
+    )
+    START_TASK_TEMPLATE = (
+        BROADCAST_TEMPLATE.format(action=f"{PACKAGE}.benchmark.START_TASK")
+        + " --es task {task} --es task_id {task_id}"
+    )
     RESULT_PATH = "files/benchmark_result.json"
+    IDLE_MARKER_PATH = "files/idle.marker"
+    # Rewritten by _watch_script() until the inotify watch reports an event
+    WATCH_PROBE_PATH = "files/.watch_probe"
+    # Host-side bound for device commands; waits get the task timeout plus
+    # WAIT_TIMEOUT_MARGIN instead
+    COMMAND_TIMEOUT = 30.0
+    WAIT_TIMEOUT_MARGIN = 10.0
+    # Result keys consumed by the benchmark runner
+    RESULT_FIELDS = frozenset({"status", "duration_ms", "task_id", "task", "final_message"})
 
     def __init__(
         self,
         api_key: str,
         model: str = "claude-sonnet-4-5-20250929",
-        poll_interval: float = 2.0,
         timeout: float = 300.0,
+        serial: str | None = None,
+        full_result: bool = False,
+        always_reset: bool = False,
     ):
         self.api_key = api_key
         self.model = model
-        self.poll_interval = poll_interval
         self.timeout = timeout
+        self.serial = serial
+        self.full_result = full_result
+        self.always_reset = always_reset
+        # Set when the last task completed cleanly, letting reset() skip
+        self._clean = False
+        # Cleared if the installed app never acknowledges STOP_TASK
+        self._idle_marker_supported = True
+        self._installed: bool | None = None
+        self._adb = _AdbClient(serial)
+        # Persistent interactive shell (no pty) on a single adb socket;
+        # reopened lazily by _shell_exec after a failed command
+        self._shell: socket.socket | None = self._adb.open("shell,v2,raw:")
+        if not self.verify():
+            self.close()
+            device = f" on {serial}" if serial else ""
+            raise RuntimeError(
+                f"Agent Relay is not installed{device}. Run setup_emulator.sh first."
+            )
+        self._inotify_supported = self._probe_inotify()
         self._configure()
 
-    def _adb(self, *args: str, check: bool = True) -> subprocess.CompletedProcess:
-        cmd = ["adb"] + list(args)
-        return subprocess.run(cmd, capture_output=True, text=True, check=check)
+    def verify(self) -> bool:
+        """Check (once) that Agent Relay is installed on the device."""
+        if self._installed is None:
+            _, packages = self._shell_exec(f"pm list packages {self.PACKAGE}")
+            self._installed = f"package:{self.PACKAGE}" in packages.split()
+        return self._installed
+
+    def close(self) -> None:
+        """Terminate the persistent adb shell session."""
+        shell = getattr(self, "_shell", None)
+        if shell is None:
+            return
+        self._shell = None
+        try:
+            self._adb.send_packet(shell, _AdbClient.CLOSE_STDIN)
+        except OSError:
+            pass
+        shell.close()
+
+    def __del__(self) -> None:
+        self.close()
+
+    def _shell_exec(self, cmd_str: str, timeout: float | None = None) -> tuple[int, str]:
+        # Run a command on the persistent adb shell and read its output up to
+        # a unique sentinel carrying the exit status. The sentinel is preceded
+        # by a newline because the output (e.g. the result JSON) may not end
+        # with one. Only stdout is collected: stderr packets can trail the
+        # sentinel and would otherwise leak into the next command's output.
+        # Raises TimeoutError if the command does not finish within `timeout`
+        # (default COMMAND_TIMEOUT). On that or any other error the session
+        # is dropped, since it is stuck or dead, and reopened on next use.
+        if self._shell is None:
+            self._shell = self._adb.open("shell,v2,raw:")
+        shell = self._shell
+
+        sentinel = f"__END_{uuid.uuid4().hex}__"
+        script = f"{cmd_str}\nprintf '\\n{sentinel} %d\\n' $?\n"
+        end = re.compile(rb"\n" + sentinel.encode() + rb" (\d+)\n")
+        output = b""
+        try:
+            shell.settimeout(timeout or self.COMMAND_TIMEOUT)
+            self._adb.send_packet(shell, _AdbClient.STDIN, script.encode())
+            while True:
+                packet_id, data = self._adb.recv_packet(shell)
+                if packet_id == _AdbClient.EXIT:
+                    raise RuntimeError("adb shell session closed unexpectedly")
+                if packet_id != _AdbClient.STDOUT:
+                    continue
+                output += data
+                match = end.search(output)
+                if match:
+                    body = output[:match.start()].decode(errors="replace").strip()
+                    return int(match.group(1)), body
+        except Exception:
+            self.close()
+            raise
+
+    def _broadcast_command(self, action: str, extras: dict[str, str] | None = None) -> str:
+        shell_cmd = self.BROADCAST_TEMPLATE.format(action=action)
+        if not extras:
+            return shell_cmd
+        return " ".join([shell_cmd] + [
+            f"--es {key} {shlex.quote(value)}" for key, value in extras.items()
+        ])
 
     def _broadcast(self, action: str, extras: dict[str, str] | None = None) -> None:
-        # Build the full am broadcast command as a single shell string
-        # to avoid adb shell argument splitting issues with spaces/quotes
-        shell_cmd = (
-            f"am broadcast"
-            f" -n {self.PACKAGE}/{self.PACKAGE}.benchmark.BenchmarkReceiver"
-            f" -a {action}"
-        )
-        if extras:
-            for key, value in extras.items():
-                # Escape single quotes in value for shell, then wrap in single quotes
-                escaped = value.replace("'", "'\\''")
-                shell_cmd += f" --es {key} '{escaped}'"
-        self._adb("shell", shell_cmd)
+        self._shell_exec(self._broadcast_command(action, extras))
 
     def _configure(self) -> None:
         self._broadcast(
@@ -56,44 +240,151 @@ class AgentRelayAgent:
             {"api_key": self.api_key, "model": self.model},
         )
 
-    def _read_result(self) -> dict[str, Any] | None:
-        result = self._adb(
-            "shell", "run-as", self.PACKAGE, "cat", self.RESULT_PATH,
-            check=False,
+    def _watch_script(self, timeout: float, check: str) -> str:
+        # Stream completed-write events in the results directory from
+        # `inotifyd -`, which prints them to stdout as "ev<TAB>dir<TAB>file"
+        # lines, so nothing is exec'd from app storage (blocked under run-as
+        # on Android 10+). `check` runs once before the first blocking read,
+        # so a file written before the watch is armed is still seen, and
+        # again after each event; the script succeeds once it does, or fails
+        # when the watch ends. The first line is inotifyd's pid so the reader
+        # can stop it early; stderr is discarded so the shell's job notice for
+        # the killed watcher stays out of the output.
+        #
+        # Until the first event arrives, WATCH_PROBE_PATH is rewritten with a
+        # shell redirect, i.e. a real open-for-write and close. `touch` cannot
+        # do this: toybox touch only calls utimensat on an existing file
+        # (IN_ATTRIB) and creates a missing one with a read-only open
+        # (IN_CREATE plus close-nowrite), neither of which is the `w` event
+        # watched here (verified against toybox semantics).
+        watch_dir = os.path.dirname(self.RESULT_PATH)
+        return (
+            f'{{ timeout {max(1, int(timeout))} sh -c "echo \\$\\$; exec inotifyd - {watch_dir}:w"'
+            " | { read pid; rc=0; ev=;"
+            f" (while :; do : > {self.WATCH_PROBE_PATH}; sleep 0.05; done) & probe=$!;"
+            f" until {check}; do read -r ev dir file || {{ rc=1; break; }};"
+            " kill $probe 2>/dev/null; done;"
+            " kill $probe $pid 2>/dev/null; exit $rc; }; } 2>/dev/null"
         )
-        if result.returncode != 0 or not result.stdout.strip():
+
+    def _probe_inotify(self) -> bool:
+        # Check that inotifyd and timeout exist and that a watch on the
+        # results directory actually delivers events under run-as. Returns
+        # False otherwise, in which case waits fall back to polling.
+        script = self._watch_script(3, '[ -n "$ev" ]')
+        rc, _ = self._shell_exec(f"run-as {self.PACKAGE} sh -c '{script}'")
+        return rc == 0
+
+    def _wait_command(self, task_id: str, timeout: float) -> str:
+        # Block on the device until the result file carries this task's id
+        # (or the deadline passes) so a single shell command covers the whole
+        # wait. Gson writes compact JSON, so the id appears as "task_id":"<id>".
+        needle = f'\\"task_id\\":\\"{task_id}\\"'
+        if self._inotify_supported:
+            # Sleep on a kernel inotify watch for completed writes in the
+            # results directory, re-checking the file after each one
+            script = f'n="{needle}"; ' + self._watch_script(
+                timeout, f'grep -qF "$n" {self.RESULT_PATH} 2>/dev/null',
+            )
+        else:
+            script = (
+                f"end=$(($(date +%s)+{int(timeout)}));"
+                f' while ! grep -qF "{needle}" {self.RESULT_PATH} 2>/dev/null'
+                f" && [ $(date +%s) -lt $end ];"
+                f" do sleep 0.1; done"
+            )
+        return f"run-as {self.PACKAGE} sh -c '{script}'"
+
+    def _read_result(self, task_id: str) -> dict[str, Any] | None:
+        # exec returns the file as raw bytes (no shell line-ending
+        # translation), which both parsers accept without a separate decode.
+        output = self._adb.exec_out(
+            f"run-as {self.PACKAGE} cat {self.RESULT_PATH}", self.COMMAND_TIMEOUT,
+        )
+        # Skip the parser for missing, empty or partially written files;
+        # trailing whitespace (e.g. a final newline) does not count
+        tail = output.rstrip()
+        if len(tail) < 2 or tail[-1:] not in (b"}", b"]"):
             return None
         try:
-            return json.loads(result.stdout.strip())
-        except json.JSONDecodeError:
+            if orjson is not None:
+                parsed = orjson.loads(output)
+            else:
+                parsed = json.loads(output)
+        except ValueError:
+            return None
+        # A result left over from an earlier task is stale
+        if not isinstance(parsed, dict) or parsed.get("task_id") != task_id:
             return None
+        return parsed
 
-    def _delete_result(self) -> None:
-        self._adb(
-            "shell", "run-as", self.PACKAGE, "rm", "-f", self.RESULT_PATH,
-            check=False,
+    def _read_result_streaming(self, task_id: str) -> dict[str, Any] | None:
+        # Parse the result incrementally off the exec socket and keep only
+        # the keys the runner consumes, so large embedded payloads (logs,
+        # transcripts) are never materialized.
+        sock = self._adb.open(
+            f"exec:run-as {self.PACKAGE} cat {self.RESULT_PATH}", self.COMMAND_TIMEOUT,
         )
+        stream = sock.makefile("rb")
+        result: dict[str, Any] = {}
+        try:
+            for key, value in ijson.kvitems(stream, "", use_float=True):
+                if key == "task_id" and value != task_id:
+                    return None  # stale result from an earlier task
+                if key in self.RESULT_FIELDS:
+                    result[key] = value
+                    if len(result) == len(self.RESULT_FIELDS):
+                        break
+        except ijson.JSONError:
+            return None
+        finally:
+            stream.close()
+            sock.close()
+        if result.get("task_id") != task_id:
+            return None
+        return result
 
-    def step(self, goal: str) -> dict[str, Any]:
-        """Execute a single task and return the result."""
-        task_id = str(uuid.uuid4())[:8]
+    def _run_task_remote(self, goal: str, task_id: str, timeout: float) -> dict[str, Any] | None:
+        # Start the task and wait for its result in one shell command, then
+        # fetch the result file. There is no delete round-trip: results are
+        # matched on task_id, and anything else is treated as stale.
+        deadline = time.time() + timeout
+        self._shell_exec("; ".join([
+            self.START_TASK_TEMPLATE.format(
+                task=shlex.quote(goal), task_id=shlex.quote(task_id),
+            ),
+            self._wait_command(task_id, timeout),
+        ]), timeout + self.WAIT_TIMEOUT_MARGIN)
+        while True:
+            if self.full_result or ijson is None:
+                result = self._read_result(task_id)
+            else:
+                result = self._read_result_streaming(task_id)
+            if result is not None or time.time() >= deadline:
+                return result
+            # Stale or partially written file; back off briefly so a file
+            # that still matches the wait is not re-read in a tight loop
+            time.sleep(min(0.2, max(deadline - time.time(), 0)))
+            remaining = deadline - time.time()
+            self._shell_exec(
+                self._wait_command(task_id, remaining), remaining + self.WAIT_TIMEOUT_MARGIN,
+            )
 
-        # Clear any previous result
-        self._delete_result()
+    def _delete_result(self) -> None:
+        self._shell_exec(f"run-as {self.PACKAGE} rm -f {self.RESULT_PATH}")
 
-        # Start the task
-        self._broadcast(
-            "com.agentrelay.benchmark.START_TASK",
-            {"task": goal, "task_id": task_id},
-        )
+    def step(self, goal: str) -> dict[str, Any]:
+        """Execute a single task and return the result."""
+        task_id = f"{os.getpid():x}-{next(_task_counter):08x}"
 
-        # Poll for result
         start_time = time.time()
-        while time.time() - start_time < self.timeout:
-            time.sleep(self.poll_interval)
-            result = self._read_result()
-            if result is not None:
-                return result
+        try:
+            result = self._run_task_remote(goal, task_id, self.timeout)
+        except TimeoutError:
+            result = None  # device stopped responding; report as a timeout
+        self._clean = result is not None and result.get("status") == "completed"
+        if result is not None:
+            return result
 
         return {
             "task_id": task_id,
@@ -104,9 +395,40 @@ class AgentRelayAgent:
             "final_message": f"Timed out after {self.timeout}s",
         }
 
+    def _stop_task(self) -> None:
+        # Send STOP_TASK and wait (up to ~2s) for the receiver to write the
+        # idle marker, which it does once the cancelled agent loop has
+        # finished. Older builds without the marker get the previous fixed
+        # settle time.
+        if not self._idle_marker_supported:
+            self._broadcast("com.agentrelay.benchmark.STOP_TASK")
+            time.sleep(0.5)
+            return
+
+        wait_script = (
+            "i=0;"
+            f" while [ ! -e {self.IDLE_MARKER_PATH} ] && [ $i -lt 100 ];"
+            " do sleep 0.02; i=$((i+1)); done;"
+            f" [ -e {self.IDLE_MARKER_PATH} ]"
+        )
+        rc, _ = self._shell_exec("; ".join([
+            f"run-as {self.PACKAGE} rm -f {self.IDLE_MARKER_PATH}",
+            self._broadcast_command("com.agentrelay.benchmark.STOP_TASK"),
+            f"run-as {self.PACKAGE} sh -c '{wait_script}'",
+        ]))
+        if rc != 0:
+            self._idle_marker_supported = False
+
     def reset(self) -> None:
-        """Stop any running task, clean up, and go home."""
-        self._broadcast("com.agentrelay.benchmark.STOP_TASK")
+        """Stop any running task, clean up, and go home.
+
+        Skipped when the previous task completed cleanly, unless
+        `always_reset` is set.
+        """
+        if self._clean and not self.always_reset:
+            self._clean = False
+            return
+        self._clean = False
+        self._stop_task()
         self._delete_result()
-        time.sleep(0.5)
-        self._adb("shell", "input", "keyevent", "3")  # HOME
+        self._shell_exec("input keyevent 3")  # HOME
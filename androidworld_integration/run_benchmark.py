@@ -4,110 +4,310 @@
 Usage:
     python run_benchmark.py --api_key sk-ant-... --tasks all
     python run_benchmark.py --api_key sk-ant-... --tasks ContactsAddContact,ClockSetAlarm
+    python run_benchmark.py --api_key sk-ant-... --tasks all --devices emulator-5554,emulator-5556
+    python run_benchmark.py --api_key sk-ant-... --tasks all --serial emulator-5554
+
+Without --serial/--devices, ANDROID_SERIAL (if set) selects the device;
+otherwise every device listed by `adb devices` is used.
 """
 
 import argparse
+import contextlib
+import functools
 import json
+import os
+import queue
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Callable
 
 from agent_relay_agent import AgentRelayAgent
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib serializer
+    orjson = None
+
+
+def _json_line(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def load_ndjson(path: Path) -> list[dict]:
+    """Read the per-task results appended to an NDJSON file by a previous run."""
+    if not path.exists():
+        return []
+    loads = orjson.loads if orjson is not None else json.loads
+    results = []
+    with path.open("rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                results.append(loads(line))
+            except ValueError:
+                pass  # truncated line from an interrupted run
+    return results
+
+
+def start_adb_server() -> None:
+    """Start the adb server if it is not running.
 
-def verify_installation() -> bool:
-    """Check that Agent Relay is installed on the connected device."""
+    Agents talk to the server over its socket, which, unlike the adb binary,
+    does not start it on demand.
+    """
+    subprocess.run(["adb", "start-server"], capture_output=True, check=False)
+
+
+def list_devices() -> list[str]:
+    """Return the serials of all devices reported as ready by `adb devices`."""
     result = subprocess.run(
-        ["adb", "shell", "pm", "list", "packages", "com.agentrelay"],
-        capture_output=True, text=True, check=False,
+        ["adb", "devices"], capture_output=True, text=True, check=False,
     )
-    if "com.agentrelay" not in result.stdout:
-        print("ERROR: Agent Relay is not installed. Run setup_emulator.sh first.")
-        return False
-    return True
+    serials = []
+    for line in result.stdout.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 2 and parts[1] == "device":
+            serials.append(parts[0])
+    return serials
+
+
+@functools.cache
+def _aw() -> tuple[Any, Any] | None:
+    """Import android_world once; returns (task_registry, env) or None if not installed."""
+    try:
+        from android_world import task_registry, env  # type: ignore
+    except ImportError:
+        return None
+    return task_registry, env
 
 
+@functools.lru_cache(maxsize=1)
 def get_available_tasks() -> list[str]:
     """Return the list of AndroidWorld task names.
 
     When the android_world package is installed, this imports tasks from it.
     Otherwise returns a small default set for smoke-testing.
     """
-    try:
-        from android_world import task_registry  # type: ignore
+    aw = _aw()
+    if aw is not None:
+        task_registry, _ = aw
         return list(task_registry.TASK_REGISTRY.keys())
-    except ImportError:
-        # Fallback: common tasks for quick testing without full AndroidWorld
-        return [
-            "ContactsAddContact",
-            "ClockSetAlarm",
-            "ClockSetTimer",
-            "SettingsToggleWifi",
-            "SettingsToggleBluetooth",
-        ]
 
+    # Fallback: common tasks for quick testing without full AndroidWorld
+    return [
+        "ContactsAddContact",
+        "ClockSetAlarm",
+        "ClockSetTimer",
+        "SettingsToggleWifi",
+        "SettingsToggleBluetooth",
+    ]
+
+
+def run_on_devices(
+    agents: list[AgentRelayAgent],
+    task_names: list[str],
+    run_task: Callable[[AgentRelayAgent, str], dict],
+    on_result: Callable[[dict], None] | None = None,
+) -> list[dict]:
+    """Run `run_task` for every task, one worker per device-bound agent.
+
+    Results are returned in the same order as `task_names`; `on_result` is
+    also called with each one as soon as it is available.
+    """
+    pool: queue.Queue[AgentRelayAgent] = queue.Queue()
+    for agent in agents:
+        pool.put(agent)
+    # Pre-sized so workers can store results by index as they finish
+    results: list[Any] = [None] * len(task_names)
+
+    def run_one_task(index: int, task_name: str) -> None:
+        agent = pool.get()
+        try:
+            results[index] = run_task(agent, task_name)
+        finally:
+            pool.put(agent)
+        if on_result is not None:
+            on_result(results[index])
 
-def run_with_android_world(agent: AgentRelayAgent, task_names: list[str]) -> list[dict]:
-    """Run tasks using the full AndroidWorld framework (if installed)."""
-    try:
-        from android_world import task_registry, env as aw_env  # type: ignore
-    except ImportError:
-        print("android_world package not found. Running in standalone mode.")
-        return run_standalone(agent, task_names)
+    with ThreadPoolExecutor(max_workers=len(agents)) as executor:
+        list(executor.map(run_one_task, range(len(task_names)), task_names))
+    return results
 
-    results = []
-    env = aw_env.AndroidWorldEnv()
 
-    for task_name in task_names:
-        if task_name not in task_registry.TASK_REGISTRY:
-            print(f"  SKIP: Unknown task '{task_name}'")
-            results.append({"task": task_name, "status": "skipped", "success": False})
-            continue
+def run_pipelined_on_devices(
+    agents: list[AgentRelayAgent],
+    task_names: list[str],
+    prepare: Callable[[AgentRelayAgent, str], Any],
+    execute: Callable[[AgentRelayAgent, str, Any, contextlib.AbstractContextManager], dict],
+    tear_down: Callable[[AgentRelayAgent, Any], None],
+    on_result: Callable[[dict], None] | None = None,
+) -> list[dict]:
+    """Like `run_on_devices`, but tears tasks down in the background.
+
+    Each device runs `prepare` and `execute` for its tasks in order, and hands
+    `tear_down` to a background thread once a result is in. `prepare` for the
+    next task only starts after `execute` has returned (so after any grading
+    it does) and after the tear_down before that has finished, so at most one
+    tear_down is outstanding. The outstanding one may still run during the
+    next task's setup and execution: `prepare` and `tear_down` are serialized
+    per device by a lock that is also passed to `execute`, to hold around any
+    other device access that must not interleave with them. `prepare` and
+    `tear_down` must not raise. Results are returned in the same order as
+    `task_names`.
+    """
+    pending: queue.Queue[tuple[int, str]] = queue.Queue()
+    for item in enumerate(task_names):
+        pending.put(item)
+    results: list[Any] = [None] * len(task_names)
+
+    def run_device(agent: AgentRelayAgent) -> None:
+        stage_lock = threading.Lock()
+        # Released when a tear_down finishes; the first two tasks have no
+        # earlier tear_down to wait for
+        torn_down = threading.Semaphore(2)
+
+        def locked_tear_down(state: Any) -> None:
+            try:
+                with stage_lock:
+                    tear_down(agent, state)
+            finally:
+                torn_down.release()
+
+        with ThreadPoolExecutor(max_workers=1) as teardown_executor:
+            while True:
+                try:
+                    index, task_name = pending.get_nowait()
+                except queue.Empty:
+                    return
+                torn_down.acquire()
+                with stage_lock:
+                    state = prepare(agent, task_name)
+                results[index] = execute(agent, task_name, state, stage_lock)
+                teardown_executor.submit(locked_tear_down, state)
+                if on_result is not None:
+                    on_result(results[index])
+
+    with ThreadPoolExecutor(max_workers=len(agents)) as executor:
+        list(executor.map(run_device, agents))
+    return results
+
 
-        print(f"\n--- Task: {task_name} ---")
-        task = task_registry.TASK_REGISTRY[task_name](env)
+def run_with_android_world(
+    agents: list[AgentRelayAgent],
+    task_names: list[str],
+    pipeline: bool = False,
+    on_result: Callable[[dict], None] | None = None,
+) -> list[dict]:
+    """Run tasks using the full AndroidWorld framework (if installed).
 
+    With `pipeline`, each task is torn down in the background while the next
+    one is set up and run. This is unsafe when consecutive tasks use the same
+    apps, as a teardown can change state the next task relies on.
+    """
+    aw = _aw()
+    if aw is None:
+        print("android_world package not found. Running in standalone mode.")
+        return run_standalone(agents, task_names, on_result)
+    task_registry, aw_env = aw
+
+    registry_keys = set(task_registry.TASK_REGISTRY)
+    envs = {agent.serial: aw_env.AndroidWorldEnv(serial=agent.serial) for agent in agents}
+
+    def prepare(agent: AgentRelayAgent, task_name: str) -> tuple[Any, Exception | None]:
+        # Construct and initialize the task; errors are reported by execute()
+        if task_name not in registry_keys:
+            return None, None
+        env = envs[agent.serial]
+        task = None
         try:
-            # Initialize task state
+            task = task_registry.TASK_REGISTRY[task_name](env)
             task.initialize(env)
+            return task, None
+        except Exception as e:
+            return task, e
+
+    def execute(
+        agent: AgentRelayAgent,
+        task_name: str,
+        prepared: tuple[Any, Exception | None],
+        stage_lock: contextlib.AbstractContextManager | None = None,
+    ) -> dict:
+        task, error = prepared
+        if task is None and error is None:
+            print(f"  SKIP: Unknown task '{task_name}'")
+            return {"task": task_name, "status": "skipped", "success": False}
+
+        print(f"\n--- Task: {task_name} [{agent.serial}] ---")
+        try:
+            if error is not None:
+                raise error
             goal = task.goal
 
             # Run the agent
             agent.reset()
             result = agent.step(goal)
-            print(f"  Agent result: {result.get('status', 'unknown')}")
+            print(f"  {task_name} agent result: {result.get('status', 'unknown')}")
 
-            # Check ground truth
-            success = task.is_successful(env)
-            print(f"  Ground truth: {'PASS' if success else 'FAIL'}")
+            # Check ground truth; when pipelined, without the previous
+            # task's teardown changing the device mid-check
+            with stage_lock or contextlib.nullcontext():
+                success = task.is_successful(envs[agent.serial])
+            print(f"  {task_name} ground truth: {'PASS' if success else 'FAIL'}")
 
-            results.append({
+            return {
                 "task": task_name,
                 "goal": goal,
                 "agent_status": result.get("status"),
                 "duration_ms": result.get("duration_ms"),
                 "success": success,
-            })
+            }
 
         except Exception as e:
-            print(f"  ERROR: {e}")
-            results.append({
+            print(f"  {task_name} ERROR: {e}")
+            return {
                 "task": task_name,
                 "status": "error",
                 "error": str(e),
                 "success": False,
-            })
+            }
+
+    def tear_down(agent: AgentRelayAgent, prepared: tuple[Any, Exception | None]) -> None:
+        task, _ = prepared
+        if task is None:
+            return
+        try:
+            task.tear_down(envs[agent.serial])
+        except Exception:
+            pass
+
+    if pipeline:
+        return run_pipelined_on_devices(
+            agents, task_names, prepare, execute, tear_down, on_result,
+        )
+
+    def run_task(agent: AgentRelayAgent, task_name: str) -> dict:
+        prepared = prepare(agent, task_name)
+        try:
+            return execute(agent, task_name, prepared)
         finally:
-            try:
-                task.tear_down(env)
-            except Exception:
-                pass
+            tear_down(agent, prepared)
 
-    return results
+    return run_on_devices(agents, task_names, run_task, on_result)
 
 
-def run_standalone(agent: AgentRelayAgent, task_names: list[str]) -> list[dict]:
+def run_standalone(
+    agents: list[AgentRelayAgent],
+    task_names: list[str],
+    on_result: Callable[[dict], None] | None = None,
+) -> list[dict]:
     """Run tasks without the AndroidWorld framework (just sends goals to agent)."""
     # Map task names to natural language goals for standalone mode
     task_goals = {
@@ -118,27 +318,36 @@ def run_standalone(agent: AgentRelayAgent, task_names: list[str]) -> list[dict]:
         "SettingsToggleBluetooth": "Open Settings and toggle Bluetooth",
     }
 
-    results = []
-    for task_name in task_names:
+    def run_task(agent: AgentRelayAgent, task_name: str) -> dict:
         goal = task_goals.get(task_name, f"Complete the task: {task_name}")
-        print(f"\n--- Task: {task_name} ---")
+        print(f"\n--- Task: {task_name} [{agent.serial}] ---")
         print(f"  Goal: {goal}")
 
-        agent.reset()
-        result = agent.step(goal)
+        try:
+            agent.reset()
+            result = agent.step(goal)
+        except Exception as e:
+            # e.g. a dropped adb connection; the agent reconnects on next use
+            print(f"  {task_name} ERROR: {e}")
+            return {
+                "task": task_name,
+                "status": "error",
+                "error": str(e),
+                "success": False,
+            }
         status = result.get("status", "unknown")
-        print(f"  Result: {status} ({result.get('duration_ms', 0)}ms)")
-        print(f"  Message: {result.get('final_message', '')}")
+        print(f"  {task_name} result: {status} ({result.get('duration_ms', 0)}ms)")
+        print(f"  {task_name} message: {result.get('final_message', '')}")
 
-        results.append({
+        return {
             "task": task_name,
             "goal": goal,
             "agent_status": status,
             "duration_ms": result.get("duration_ms"),
             "success": status == "completed",
-        })
+        }
 
-    return results
+    return run_on_devices(agents, task_names, run_task, on_result)
 
 
 def main():
@@ -148,30 +357,132 @@ def main():
     parser.add_argument("--tasks", default="all", help="Comma-separated task names or 'all'")
     parser.add_argument("--timeout", type=float, default=300.0, help="Per-task timeout in seconds")
     parser.add_argument("--output", default="benchmark_results.json", help="Output file path")
+    parser.add_argument(
+        "--serial", default=None,
+        help="adb serial of the single device to run on (overrides ANDROID_SERIAL)",
+    )
+    parser.add_argument(
+        "--devices", default=None,
+        help="Comma-separated adb serials to run tasks on concurrently",
+    )
+    parser.add_argument(
+        "--parallel", type=int, default=None,
+        help=(
+            "Run tasks concurrently on up to this many devices"
+            " (from --devices, or all connected devices)"
+        ),
+    )
+    parser.add_argument(
+        "--full-result", action="store_true",
+        help="Parse the whole result file instead of streaming only the summary fields",
+    )
+    parser.add_argument(
+        "--always-reset", action="store_true",
+        help="Reset the device before every task, even after a clean completion",
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Skip tasks already recorded in the .ndjson results file from a previous run",
+    )
+    parser.add_argument(
+        "--pipeline", action="store_true",
+        help=(
+            "Tear down each task in the background while the next one is set up and runs."
+            " UNSAFE for task sets where consecutive tasks use the same apps: a teardown"
+            " can change state the next task relies on"
+        ),
+    )
     args = parser.parse_args()
 
-    if not verify_installation():
+    # Each result is appended to an NDJSON file as soon as it is in, so an
+    # interrupted run keeps its progress and can be picked up with --resume.
+    output_path = Path(args.output)
+    ndjson_path = output_path.with_suffix(".ndjson")
+    if ndjson_path == output_path:
+        print(f"ERROR: --output must not end in {ndjson_path.suffix}; that name is used for the per-task log.")
         sys.exit(1)
 
-    agent = AgentRelayAgent(
-        api_key=args.api_key,
-        model=args.model,
-        timeout=args.timeout,
-    )
+    if args.serial:
+        devices = [args.serial]
+    elif args.devices:
+        devices = [d.strip() for d in args.devices.split(",") if d.strip()]
+    elif os.environ.get("ANDROID_SERIAL"):
+        devices = [os.environ["ANDROID_SERIAL"]]
+    else:
+        devices = list_devices()
+        if not args.parallel and len(devices) > 1:
+            # Fanning out is opt-in; by default run on a single device as before
+            print(f"Multiple devices connected; using {devices[0]} (see --devices/--parallel)")
+            devices = devices[:1]
+    if args.parallel:
+        devices = devices[:args.parallel]
+    if not devices:
+        print("ERROR: No adb devices found.")
+        sys.exit(1)
+    if len(devices) == 1:
+        # Resolved once: pin every child adb invocation (e.g. from
+        # AndroidWorld) to this device, even if more get connected later
+        os.environ["ANDROID_SERIAL"] = devices[0]
+
+    try:
+        start_adb_server()
+        agents = [
+            AgentRelayAgent(
+                api_key=args.api_key,
+                model=args.model,
+                timeout=args.timeout,
+                serial=serial,
+                full_result=args.full_result,
+                always_reset=args.always_reset,
+            )
+            for serial in devices
+        ]
+    except (RuntimeError, OSError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
 
     available_tasks = get_available_tasks()
     if args.tasks == "all":
-        task_names = available_tasks
+        task_names = list(available_tasks)
     else:
         task_names = [t.strip() for t in args.tasks.split(",")]
 
-    print(f"Running {len(task_names)} tasks with model={args.model}")
+    resumed = load_ndjson(ndjson_path) if args.resume else []
+    done = {r.get("task") for r in resumed}
+    pending = [t for t in task_names if t not in done]
+    if done:
+        print(f"Resuming: {len(task_names) - len(pending)} task(s) already recorded in {ndjson_path}")
+
+    print(f"Running {len(pending)} tasks on {len(agents)} device(s) with model={args.model}")
     start_time = time.time()
 
-    results = run_with_android_world(agent, task_names)
+    ndjson_lock = threading.Lock()
+    with ndjson_path.open("a" if args.resume else "w", buffering=1) as ndjson:
+        if ndjson.tell() > 0:
+            ndjson.write("\n")  # terminate a line cut short by an interrupted run
+        def record(result: dict) -> None:
+            line = _json_line(result) + "\n"
+            with ndjson_lock:
+                ndjson.write(line)
+
+        try:
+            results = run_with_android_world(
+                agents, pending, pipeline=args.pipeline, on_result=record,
+            )
+        finally:
+            for agent in agents:
+                agent.close()
+
+    # Resumed results count towards the summary only for requested tasks
+    requested = set(task_names)
+    results = [r for r in resumed if r.get("task") in requested] + results
 
     total_time = time.time() - start_time
-    passed = sum(1 for r in results if r.get("success"))
+    passed = 0
+    total_duration_ms = 0
+    for r in results:
+        passed += bool(r.get("success"))
+        total_duration_ms += r.get("duration_ms") or 0
     total = len(results)
     success_rate = (passed / total * 100) if total > 0 else 0
 
@@ -182,6 +493,7 @@ def main():
         "failed": total - passed,
         "success_rate": round(success_rate, 1),
         "total_time_s": round(total_time, 1),
+        "total_agent_time_s": round(total_duration_ms / 1000, 1),
         "results": results,
     }
 
@@ -189,8 +501,10 @@ def main():
     print(f"Results: {passed}/{total} ({success_rate:.1f}%)")
     print(f"Total time: {total_time:.1f}s")
 
-    output_path = Path(args.output)
-    output_path.write_text(json.dumps(summary, indent=2))
+    if orjson is not None:
+        output_path.write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+    else:
+        output_path.write_text(json.dumps(summary, indent=2))
     print(f"Results saved to {output_path}")
 
 
@@ -220,8 +220,13 @@ class AgentOrchestrator(private val context: Context) {
     /** Returns true if the agent loop is currently executing a task */
     fun isCurrentlyRunning(): Boolean = isRunning
 
-    fun stop() {
-        if (!isRunning && currentJob == null) return // already stopped
+    /**
+     * Stops the agent and returns the cancelled agent loop job, if any.
+     * Cancellation is not awaited; use [Job.invokeOnCompletion] on the
+     * result to act once the loop has actually finished.
+     */
+    fun stop(): Job? {
+        if (!isRunning && currentJob == null) return null // already stopped
         isRunning = false
 
         // Stop screen recording BEFORE cancelling the coroutine so the
@@ -233,7 +238,8 @@ class AgentOrchestrator(private val context: Context) {
             addStatus("Recording saved: ${recordingFile.name}")
         }
 
-        currentJob?.cancel()
+        val job = currentJob
+        job?.cancel()
         currentJob = null
 
         // Hide touch block overlay and clear intervention tracker
@@ -252,6 +258,7 @@ class AgentOrchestrator(private val context: Context) {
         }
         addStatus("Agent stopped")
         Log.d(TAG, "Agent stopped")
+        return job
     }
 
     private fun addStatus(message: String) {
@@ -97,7 +97,15 @@ class BenchmarkReceiver : BroadcastReceiver() {
 
     private fun handleStopTask(context: Context) {
         Log.d(TAG, "Stopping benchmark task")
-        AgentOrchestrator.getInstance(context).stop()
+        val appContext = context.applicationContext
+        val job = AgentOrchestrator.getInstance(context).stop()
+        // STOP_TASK_ACK: stop() only cancels the agent loop, so write the
+        // idle marker once the cancelled job has actually completed
+        if (job == null) {
+            BenchmarkResultWriter.markIdle(appContext)
+        } else {
+            job.invokeOnCompletion { BenchmarkResultWriter.markIdle(appContext) }
+        }
     }
 
     private fun handleConfigure(context: Context, intent: Intent) {
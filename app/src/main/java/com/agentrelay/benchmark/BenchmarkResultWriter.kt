@@ -8,6 +8,7 @@ import java.io.File
 object BenchmarkResultWriter {
     private const val TAG = "BenchmarkResultWriter"
     private const val RESULT_FILE = "benchmark_result.json"
+    private const val IDLE_MARKER_FILE = "idle.marker"
 
     private var context: Context? = null
     private var taskId: String? = null
@@ -19,8 +20,9 @@ object BenchmarkResultWriter {
         this.taskId = taskId
         this.task = task
         this.startTimeMs = System.currentTimeMillis()
-        // Delete any previous result file
+        // Delete any previous result file; the agent is no longer idle
         File(ctx.filesDir, RESULT_FILE).delete()
+        File(ctx.filesDir, IDLE_MARKER_FILE).delete()
         Log.d(TAG, "Prepared for task_id=$taskId")
     }
 
@@ -52,4 +54,17 @@ object BenchmarkResultWriter {
         taskId = null
         task = null
     }
+
+    /**
+     * Acknowledge a STOP_TASK by writing the idle marker, so the benchmark
+     * runner can stop waiting as soon as the agent has actually stopped.
+     */
+    fun markIdle(ctx: Context) {
+        try {
+            File(ctx.filesDir, IDLE_MARKER_FILE).writeText(System.currentTimeMillis().toString())
+            Log.d(TAG, "Idle marker written")
+        } catch (e: Exception) {
+            Log.e(TAG, "Failed to write idle marker", e)
+        }
+    }
 }